@@ -81,7 +81,8 @@ def app():
             index="start_time",
             columns="production_group",
             values="quantity_kwh",
-            aggfunc="sum"
+            aggfunc="sum",
+            observed=True
         )
         st.line_chart(pivot_df)
     else:
@@ -89,7 +90,7 @@ def app():
 
     # --- Production Share by Group (Interactive Pie) ---
     st.header("Production Share by Group")
-    production_by_group = df_filtered.groupby("production_group")["quantity_kwh"].sum().reset_index()
+    production_by_group = df_filtered.groupby("production_group", observed=True)["quantity_kwh"].sum().reset_index()
 
     fig = px.pie(
         production_by_group,
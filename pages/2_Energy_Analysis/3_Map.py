@@ -2,10 +2,13 @@
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
-import json
+import orjson
 import pandas as pd
+import shapely
 from shapely.geometry import shape, Point
-from utils.data_loader import load_mongo_data
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from utils.data_loader import load_mean_per_area
 
 def app():
     # -----------------------
@@ -15,54 +18,38 @@ def app():
     st.title("🗺️ Price Areas & Energy Analysis")
 
     # -----------------------
-    # Load GeoJSON (cached)
+    # Load GeoJSON + build polygons (cached on file content)
     # -----------------------
-    @st.cache_data
-    def load_geojson(path="data/price_zones.geojson"):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+    @st.cache_resource
+    def build_polygons(gj_bytes: bytes):
+        gj = orjson.loads(gj_bytes)
 
-    geojson_data = load_geojson()
-
-    # Normalize GeoJSON names (remove spaces: "NO 2" -> "NO2")
-    for f in geojson_data["features"]:
-        if "ElSpotOmr" in f["properties"]:
-            f["properties"]["ElSpotOmr"] = f["properties"]["ElSpotOmr"].replace(" ", "").upper()
-
-    # Assign a proper feature.id using OBJECTID (or fallback index)
-    for i, f in enumerate(geojson_data["features"]):
-        props = f.get("properties", {})
-        f["id"] = props.get("OBJECTID", i)
-
-    # -----------------------
-    # Build id -> name mapping (cached)
-    # -----------------------
-    @st.cache_data
-    def build_id_to_name(gj):
-        out = {}
-        for f in gj.get("features", []):
-            fid = f.get("id")
+        # Normalize GeoJSON names (remove spaces: "NO 2" -> "NO2")
+        # and assign a proper feature.id using OBJECTID (or fallback index)
+        id_to_name = {}
+        for i, f in enumerate(gj["features"]):
             props = f.get("properties", {})
+            if "ElSpotOmr" in props:
+                props["ElSpotOmr"] = props["ElSpotOmr"].replace(" ", "").upper()
+            f["id"] = props.get("OBJECTID", i)
             name = props.get("ElSpotOmr") or props.get("ElSpot_omraade") or props.get("name")
-            out[fid] = (name or str(fid)).replace(" ", "").upper()
-        return out
+            id_to_name[f["id"]] = (name or str(f["id"])).replace(" ", "").upper()
 
-    id_to_name = build_id_to_name(geojson_data)
+        ids = [f["id"] for f in gj["features"]]
+        # Snap to a ~1 m grid: merges near-duplicate vertices, plenty for click lookup
+        geoms = [shapely.set_precision(shape(f["geometry"]), 1e-5) for f in gj["features"]]
+        prepared = [prep(g) for g in geoms]
+        tree = STRtree(geoms)
+        return gj, ids, prepared, tree, id_to_name
 
-    # -----------------------
-    # Build shapely polygons once
-    # -----------------------
-    if "polygons" not in st.session_state:
-        st.session_state.polygons = [
-            (f.get("id"), shape(f["geometry"]))
-            for f in geojson_data["features"]
-        ]
+    with open("data/price_zones.geojson", "rb") as f:
+        geojson_data, feature_ids, prepared_polys, poly_tree, id_to_name = build_polygons(f.read())
 
     def find_feature_id(lon: float, lat: float):
         pt = Point(lon, lat)
-        for fid, geom in st.session_state.polygons:
-            if geom.covers(pt):
-                return fid
+        for i in poly_tree.query(pt):
+            if prepared_polys[i].covers(pt):
+                return feature_ids[i]
         return None
 
     # -----------------------
@@ -75,31 +62,22 @@ def app():
         days = st.slider("Time interval (days)", 1, 30, 7)
 
     # -----------------------
-    # Load selected dataset
+    # Mean per area over the selected window (aggregated in MongoDB)
     # -----------------------
     collection_name = "production_data" if mode == "Production" else "consumption_data"
-    df = load_mongo_data(collection_name)
-
-    # -----------------------
-    # Compute mean per area
-    # -----------------------
-    if not df.empty and all(col in df.columns for col in ["price_area", "start_time", "quantity_kwh"]):
-        date_max = df["start_time"].max()
-        date_min = date_max - pd.Timedelta(days=days)
-        df_period = df[(df["start_time"] >= date_min) & (df["start_time"] <= date_max)]
-        mean_df = df_period.groupby("price_area")["quantity_kwh"].mean().round(2).reset_index()
-    else:
-        mean_df = pd.DataFrame(columns=["price_area", "quantity_kwh"])
+    mean_df = load_mean_per_area(collection_name, days)
 
     # -----------------------
     # Map mean values to features
     # -----------------------
+    pa_upper = mean_df["price_area"].astype(str).str.upper().to_numpy()
+    pa_vals = mean_df["quantity_kwh"].to_numpy()
+    name_to_idx = {name: i for i, name in enumerate(pa_upper)}
     value_map = {}
     for f in geojson_data["features"]:
         name = f["properties"].get("ElSpotOmr")
-        fid = f.get("id")
-        match = mean_df[mean_df["price_area"].str.upper() == name]
-        value_map[fid] = float(match["quantity_kwh"].iloc[0]) if not match.empty else None
+        idx = name_to_idx.get(name)
+        value_map[f.get("id")] = float(pa_vals[idx]) if idx is not None else None
 
     # -----------------------
     # Session state for pin + selected feature
@@ -113,59 +91,64 @@ def app():
         st.session_state.selected_feature_id = find_feature_id(lon, lat)
 
     # -----------------------
-    # Layout: map + info
-    # -----------------------
-
-    st.subheader("Map")
-
-    # Create folium map
-    m = folium.Map(location=st.session_state.last_pin, zoom_start=5, tiles="OpenStreetMap")
-
-    # Choropleth
-    df_vals = pd.DataFrame({"id": list(value_map.keys()),
-                            "value": [v if v is not None else 0 for v in value_map.values()]})
-    choropleth = folium.Choropleth(
-        geo_data=geojson_data,
-        data=df_vals,
-        columns=["id", "value"],
-        key_on="feature.id",
-        fill_color="YlOrRd",
-        fill_opacity=0.5,
-        line_opacity=0.6,
-        line_color="white",
-        legend_name=f"Mean {mode} kWh (last {days} days)",
-        highlight=True
-    )
-    choropleth.add_to(m)
-
-    # Highlight selected polygon
-    if st.session_state.selected_feature_id is not None:
+    # Map (fragment: pan/zoom only reruns this block)
+    # -----------------------
+    @st.fragment
+    def render_map(value_map: dict, legend_name: str):
+        st.subheader("Map")
+
+        # Create folium map
+        m = folium.Map(location=st.session_state.last_pin, zoom_start=5, tiles="OpenStreetMap")
+
+        # Choropleth
+        df_vals = pd.DataFrame({"id": list(value_map.keys()),
+                                "value": [v if v is not None else 0 for v in value_map.values()]})
+        choropleth = folium.Choropleth(
+            geo_data=geojson_data,
+            data=df_vals,
+            columns=["id", "value"],
+            key_on="feature.id",
+            fill_color="YlOrRd",
+            fill_opacity=0.5,
+            line_opacity=0.6,
+            line_color="white",
+            legend_name=legend_name,
+            highlight=True
+        )
+
+        # Highlight selected polygon by restyling its outline in the choropleth layer
         sel_id = st.session_state.selected_feature_id
-        sel_feats = [f for f in geojson_data["features"] if f.get("id") == sel_id]
-        if sel_feats:
-            folium.GeoJson(
-                {"type": "FeatureCollection", "features": sel_feats},
-                style_function=lambda f: {"fillOpacity": 0, "color": "red", "weight": 3}
-            ).add_to(m)
-
-    # Pin marker
-    folium.Marker(
-        location=st.session_state.last_pin,
-        icon=folium.Icon(color="red")
-    ).add_to(m)
-
-    # Display map full-width, taller height
-    out = st_folium(m, key="map", height=1200, width=650)
-
-    # Capture click
-    if out and out.get("last_clicked"):
-        lat = out["last_clicked"]["lat"]
-        lon = out["last_clicked"]["lng"]
-        st.session_state.last_pin = [lat, lon]
-        st.session_state.selected_feature_id = find_feature_id(lon, lat)
-        st.rerun()
-
-
+        if sel_id is not None:
+            base_style = choropleth.geojson.style_function
+
+            def style_function(feature):
+                style = base_style(feature)
+                if feature.get("id") == sel_id:
+                    style = {**style, "color": "red", "weight": 3, "opacity": 1}
+                return style
+
+            choropleth.geojson.style_function = style_function
+        choropleth.add_to(m)
+
+        # Pin marker
+        folium.Marker(
+            location=st.session_state.last_pin,
+            icon=folium.Icon(color="red")
+        ).add_to(m)
+
+        # Display map full-width, taller height
+        out = st_folium(m, key="map", height=1200, width=650)
+
+        # Capture click (a new pin needs a full rerun to refresh the info panel)
+        if out and out.get("last_clicked"):
+            lat = out["last_clicked"]["lat"]
+            lon = out["last_clicked"]["lng"]
+            if [lat, lon] != st.session_state.last_pin:
+                st.session_state.last_pin = [lat, lon]
+                st.session_state.selected_feature_id = find_feature_id(lon, lat)
+                st.rerun()
+
+    render_map(value_map, f"Mean {mode} kWh (last {days} days)")
 
     with info_col:
         st.subheader("Selection")
@@ -6,6 +6,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 from utils.data_loader import download_weather_data
 from utils.config import PRICE_AREAS
+from utils.kernels import qupot_kernel, sector_transport_kernel
 
 def app():
     # ---------------------------
@@ -59,17 +60,18 @@ def app():
     # Snow drift functions
     # ---------------------------
     def compute_Qupot(hourly_wind_speeds, dt=3600):
-        return sum((u ** 3.8) * dt for u in hourly_wind_speeds) / 233847
-
-    def sector_index(direction):
-        return int(((direction + 11.25) % 360) // 22.5)
-
-    def compute_sector_transport(hourly_wind_speeds, hourly_wind_dirs, dt=3600):
-        sectors = [0.0] * 16
-        for u, d in zip(hourly_wind_speeds, hourly_wind_dirs):
-            idx = sector_index(d)
-            sectors[idx] += ((u ** 3.8) * dt) / 233847
-        return sectors
+        # float32 input is fine: the kernel raises u to 3.8 and accumulates in float64
+        return qupot_kernel(np.ascontiguousarray(hourly_wind_speeds), float(dt))
+
+    def compute_sector_transport(hourly_wind_speeds, hourly_wind_dirs, season_codes, n_seasons, dt=3600):
+        # One (n_seasons, 16) table of transport per wind sector, filled in a single compiled pass
+        return sector_transport_kernel(
+            np.ascontiguousarray(hourly_wind_speeds),
+            np.ascontiguousarray(hourly_wind_dirs),
+            np.ascontiguousarray(season_codes, dtype=np.int64),
+            n_seasons,
+            float(dt)
+        )
 
     def compute_snow_transport(T, F, theta, Swe, hourly_wind_speeds, dt=3600):
         Qupot = compute_Qupot(hourly_wind_speeds, dt)
@@ -85,77 +87,89 @@ def app():
         return {"Qupot (kg/m)": Qupot, "Qspot (kg/m)": Qspot, "Srwe (mm)": Srwe,
                 "Qinf (kg/m)": Qinf, "Qt (kg/m)": Qt, "Control": control}
 
-    def compute_yearly_results(df, T, F, theta):
-        seasons = sorted(df['season'].unique())
+    def split_by_key(keys, *columns):
+        # Rows are sorted by time, so every key value is one contiguous block
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        return keys[np.r_[0, bounds]], [np.split(c, bounds) for c in columns]
+
+    def compute_Swe_hourly(df):
+        # Precipitation counts as snow water equivalent when it is below 1 °C
+        return np.where(df['temperature_2m'].to_numpy() < 1, df['precipitation'].to_numpy(), 0.0)
+
+    def compute_results(keys, df, T, F, theta):
+        group_keys, (swe, wind) = split_by_key(
+            keys,
+            df["Swe_hourly"].to_numpy(),
+            df["wind_speed_10m"].to_numpy()
+        )
         results_list = []
-        for s in seasons:
-            season_start = pd.Timestamp(year=s, month=7, day=1, tz='UTC')
-            season_end = pd.Timestamp(year=s+1, month=6, day=30, hour=23, minute=59, second=59, tz='UTC')
-            df_season = df[(df['time'] >= season_start) & (df['time'] <= season_end)]
-            if df_season.empty:
-                continue
-            df_season = df_season.copy()
-            df_season['Swe_hourly'] = df_season.apply(
-                lambda row: row['precipitation'] if row['temperature_2m'] < 1 else 0, axis=1)
-            total_Swe = df_season['Swe_hourly'].sum()
-            wind_speeds = df_season["wind_speed_10m"].tolist()
-            result = compute_snow_transport(T, F, theta, total_Swe, wind_speeds)
-            result["season"] = f"{s}-{s+1}"
+        for k, w, u in zip(group_keys, swe, wind):
+            total_Swe = np.nansum(w, dtype=np.float64)
+            result = compute_snow_transport(T, F, theta, total_Swe, u)
+            result["key"] = k
             results_list.append(result)
         return pd.DataFrame(results_list)
 
-    # ---------------------------
-    # Download weather data per year
-    # ---------------------------
-    dfs = []
-    with st.spinner("Downloading weather data..."):
-        for year in range(start_year, end_year + 1):
-            try:
-                df_year = download_weather_data(lat, lon, year)
-                df_year['season'] = df_year['time'].apply(lambda dt: dt.year if dt.month >= 7 else dt.year - 1)
-                dfs.append(df_year)
-            except Exception as e:
-                st.error(f"Error loading data for year {year}: {e}")
-    if not dfs:
-        st.stop()
+    def compute_yearly_results(df, T, F, theta):
+        # Qt per season and the per-season sector table come from the same season runs
+        keys = df['season'].to_numpy()
+        results = compute_results(keys, df, T, F, theta)
+        if results.empty:
+            return results, np.zeros((0, 16))
+        results["season"] = [f"{s}-{s+1}" for s in results.pop("key")]
+        season_codes = np.r_[0, np.cumsum(np.diff(keys) != 0)]
+        sectors = compute_sector_transport(
+            df["wind_speed_10m"].to_numpy(),
+            df["wind_direction_10m"].to_numpy(),
+            season_codes,
+            len(results)
+        )
+        return results, sectors
 
-    df_all = pd.concat(dfs, ignore_index=True)
+    @st.cache_data
+    def analyze_snow_drift(lat, lon, start_year, end_year, T, F, theta):
+        # Download + yearly/monthly Qt + wind rose in one cached step, so reruns with the same inputs skip it all
+        df_all = download_weather_data(lat, lon, f"{start_year}-01-01", f"{end_year}-12-31")
+        if df_all.empty:
+            return pd.DataFrame(), pd.DataFrame(), np.zeros(16)
+
+        y = df_all['time'].dt.year.to_numpy()
+        m = df_all['time'].dt.month.to_numpy()
+        df_all['season'] = np.where(m >= 7, y, y - 1).astype(np.int16)
+        df_all = df_all.sort_values('time', kind='mergesort', ignore_index=True)
+        df_all['Swe_hourly'] = compute_Swe_hourly(df_all)
+
+        # Yearly snow drift (July-June seasons)
+        yearly_df, sectors_per_season = compute_yearly_results(df_all, T, F, theta)
+        if yearly_df.empty:
+            return yearly_df, pd.DataFrame(), np.zeros(16)
+        yearly_df["Qt_tonnes"] = yearly_df["Qt (kg/m)"] / 1000
+        # Assign a datetime for plotting: first month of the season (July)
+        yearly_df['plot_time'] = yearly_df['season'].apply(lambda s: pd.Timestamp(int(s.split('-')[0]), 7, 1))
+
+        # Monthly snow drift (calendar months)
+        month_keys = (df_all['time'].dt.year * 12 + df_all['time'].dt.month - 1).to_numpy()
+        monthly_df = compute_results(month_keys, df_all, T, F, theta)
+        monthly_df['year_month'] = [pd.Timestamp(year=int(k) // 12, month=int(k) % 12 + 1, day=1) for k in monthly_df.pop("key")]
+        monthly_df["Qt_tonnes"] = monthly_df["Qt (kg/m)"] / 1000
+
+        return yearly_df, monthly_df, sectors_per_season.mean(axis=0)
 
     # ---------------------------
-    # Compute yearly snow drift
+    # Compute yearly and monthly snow drift
     # ---------------------------
     T = 3000
     F = 30000
     theta = 0.5
-    yearly_df = compute_yearly_results(df_all, T, F, theta)
+    try:
+        yearly_df, monthly_df, avg_sectors = analyze_snow_drift(lat, lon, start_year, end_year, T, F, theta)
+    except Exception as e:
+        st.error(f"Error loading weather data for {start_year}-{end_year}: {e}")
+        st.stop()
     if yearly_df.empty:
         st.warning("No snow drift data available for the selected year range.")
         st.stop()
 
-    yearly_df["Qt_tonnes"] = yearly_df["Qt (kg/m)"] / 1000
-
-    # Assign a datetime for plotting: first month of the season (July)
-    yearly_df['plot_time'] = yearly_df['season'].apply(lambda s: pd.Timestamp(int(s.split('-')[0]), 7, 1))
-
-    # ---------------------------
-    # Compute monthly snow drift
-    # ---------------------------
-    df_all['year_month'] = df_all['time'].dt.to_period('M')
-    monthly_results_list = []
-    for ym, group in df_all.groupby('year_month'):
-        group = group.copy()
-        group['Swe_hourly'] = group.apply(
-            lambda row: row['precipitation'] if row['temperature_2m'] < 1 else 0, axis=1
-        )
-        total_Swe = group['Swe_hourly'].sum()
-        wind_speeds = group["wind_speed_10m"].tolist()
-        result = compute_snow_transport(T, F, theta, total_Swe, wind_speeds)
-        result['year_month'] = ym.to_timestamp()
-        monthly_results_list.append(result)
-
-    monthly_df = pd.DataFrame(monthly_results_list)
-    monthly_df["Qt_tonnes"] = monthly_df["Qt (kg/m)"] / 1000
-
     # ---------------------------
     # Plot both yearly and monthly Qt
     # ---------------------------
@@ -191,16 +205,6 @@ def app():
     # Compute average wind rose
     # ---------------------------
     st.subheader("Average Wind Rose")
-    sectors_list = []
-    for s, group in df_all.groupby('season'):
-        group = group.copy()
-        group['Swe_hourly'] = group.apply(lambda row: row['precipitation'] if row['temperature_2m'] < 1 else 0, axis=1)
-        ws = group["wind_speed_10m"].tolist()
-        wdir = group["wind_direction_10m"].tolist()
-        sectors = compute_sector_transport(ws, wdir)
-        sectors_list.append(sectors)
-
-    avg_sectors = np.mean(sectors_list, axis=0)
     overall_avg = yearly_df['Qt (kg/m)'].mean()
     angles = np.linspace(0, 360, 16, endpoint=False)
     directions = ['N','NNE','NE','ENE','E','ESE','SE','SSE',
@@ -4,10 +4,12 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import timedelta
-from scipy.stats import ttest_ind, zscore
-from utils.data_loader import load_mongo_data, download_weather_data
-from utils.config import PRICE_AREAS, DEFAULT_YEAR, DEFAULT_PRICE_AREA
+from pandas.tseries.frequencies import to_offset
+from datetime import datetime, timedelta, timezone
+from scipy.stats import ttest_ind
+from utils.data_loader import get_energy_series, get_weather_series
+from utils.config import PRICE_AREAS, DEFAULT_PRICE_AREA, MIN_YEAR, MAX_YEAR
+from utils.kernels import mean_corr_vs_lag, rolling_corr, bucket_or
 
 def app():
     # -------------------------------------------------------
@@ -35,9 +37,6 @@ def app():
     with st.expander("Click to configure settings", expanded=True):
         mode = st.radio("Energy dataset", ["Production", "Consumption"])
         collection_name = "production_data" if mode == "Production" else "consumption_data"
-        if f"df_{collection_name}" not in st.session_state:
-            st.session_state[f"df_{collection_name}"] = load_mongo_data(collection_name)
-        df_energy = st.session_state[f"df_{collection_name}"]
 
         price_area = st.selectbox(
             "Price area (region + city)",
@@ -69,6 +68,8 @@ def app():
 
         lag = st.slider("Lag (in hours)", -168, 168, 0)
         st.caption("Tests whether weather impacts energy with a delay. Positive lag → weather leads, energy responds later; Negative lag → energy leads. Helps identify the delay at which weather most strongly affects energy.")
+        full_lag_scan = st.checkbox("Full lag scan (every lag from -72 to 72)", value=False)
+        st.caption("By default the lag scan samples every 8th lag and refines around the strongest one; the full scan evaluates all 145 lags.")
 
         st.markdown("""
     #### 🌪 Highlight extreme events
@@ -84,42 +85,45 @@ def app():
         normalize_plot = st.checkbox("Normalize series for plotting (z-score)", value=False)
         run_button = st.button("▶️ Run Analysis")
 
-    # -------------------------------------------------------
-    # Energy data preparation
-    # -------------------------------------------------------
-    @st.cache_data
-    def prepare_energy_series(df_energy: pd.DataFrame, price_area: str, resample_freq: str="H") -> pd.Series:
-        df = df_energy[df_energy["price_area"] == price_area].copy()
-        if df.empty:
-            return pd.Series(dtype=float)
-        df = df.set_index("start_time").sort_index()
-        s = df["quantity_kwh"].resample(resample_freq).sum()
-        s.name = "quantity_kwh"
-        return s
-
     # -------------------------------------------------------
     # Correlation utilities
     # -------------------------------------------------------
-    @st.cache_data
-    def sliding_window_correlation(x: pd.Series, y: pd.Series, window: int) -> pd.Series:
-        return x.rolling(window=window).corr(y)
+    def sliding_window_correlation(x: np.ndarray, y: np.ndarray, window: int) -> np.ndarray:
+        # Running-sum kernel: O(n) regardless of the window length
+        return rolling_corr(np.ascontiguousarray(x, dtype=np.float64), np.ascontiguousarray(y, dtype=np.float64), window)
 
-    @st.cache_data
-    def compute_rolled_corr(series_met: pd.Series, series_eng: pd.Series, window_hours: int, lag_hours: int) -> pd.Series:
-        # Ensure both series are timezone-naive
-        series_met = series_met.tz_localize(None) if hasattr(series_met.index, 'tz') and series_met.index.tz is not None else series_met
-        series_eng = series_eng.tz_localize(None) if hasattr(series_eng.index, 'tz') and series_eng.index.tz is not None else series_eng
+    def is_regular(index: pd.DatetimeIndex, step: pd.Timedelta) -> bool:
+        # Strictly increasing bin labels span (n - 1) steps exactly when none is missing
+        return len(index) > 0 and index[-1] - index[0] == (len(index) - 1) * step
 
-        if lag_hours != 0:
-            series_eng = series_eng.shift(-lag_hours)
+    def fast_align(a: pd.Series, b: pd.Series, step: pd.Timedelta):
+        # Both series are binned on the same `step` grid (tz_localize drops index.freq, so the
+        # step is passed in), so their common timestamps are one contiguous positional slice;
+        # only the NaN mask needs an O(n) pass
+        if not (is_regular(a.index, step) and is_regular(b.index, step)
+                and (b.index[0] - a.index[0]) % step == pd.Timedelta(0)):
+            df = pd.concat([a, b], axis=1).dropna()
+            return df.iloc[:, 0].to_numpy(copy=True), df.iloc[:, 1].to_numpy(copy=True), df.index
+        start = max(a.index[0], b.index[0])
+        end = min(a.index[-1], b.index[-1])
+        n = max((end - start) // step + 1, 0)
+        ia = (start - a.index[0]) // step
+        ib = (start - b.index[0]) // step
+        av = a.to_numpy()[ia:ia + n]
+        bv = b.to_numpy()[ib:ib + n]
+        m = ~(np.isnan(av) | np.isnan(bv))
+        return av[m], bv[m], a.index[ia:ia + n][m]
 
-        # Concatenate and drop NA values
-        df = pd.concat([series_met, series_eng], axis=1).dropna()
+    def compute_rolled_corr(x: np.ndarray, y: np.ndarray, window_hours: int, lag_hours: int):
+        # x and y are already on one time grid, so the lag is an index offset on y
+        if lag_hours > 0:
+            y = np.concatenate([y[lag_hours:], np.full(min(lag_hours, y.size), np.nan)])
+        elif lag_hours < 0:
+            y = np.concatenate([np.full(min(-lag_hours, y.size), np.nan), y[:lag_hours]])
 
-        if df.empty:
-            return pd.Series([], dtype=float)
-
-        return sliding_window_correlation(df.iloc[:, 0], df.iloc[:, 1], window_hours)
+        # Keep positions where both values exist
+        valid = ~(np.isnan(x) | np.isnan(y))
+        return valid, sliding_window_correlation(x[valid], y[valid], window_hours)
 
 
     # -------------------------------------------------------
@@ -129,50 +133,73 @@ def app():
         st.header("📈 Results")
         with st.spinner("Running analysis..."):
             # --- Retrieve and align the data ---
-            series_energy = prepare_energy_series(df_energy, price_area, freq)
+            # Only the years covered by the weather download below
+            series_energy = get_energy_series(
+                collection_name, price_area, freq,
+                start=datetime(MIN_YEAR, 1, 1, tzinfo=timezone.utc),
+                end=datetime(MAX_YEAR, 12, 31, 23, 59, 59, tzinfo=timezone.utc)
+            )
             lat, lon = PRICE_AREAS[price_area]["lat"], PRICE_AREAS[price_area]["lon"]
 
-            # Download weather data
-            df_weather = download_weather_data(lat, lon, DEFAULT_YEAR)
-            for year in range(2018, 2025):
-                if year != DEFAULT_YEAR:
-                    df_year = download_weather_data(lat, lon, year)
-                    df_weather = pd.concat([df_weather, df_year], ignore_index=True)
-
-            # Set 'time' as the index and sort
-            if "time" not in df_weather.columns:
-                st.error("Weather data does not contain a 'time' column.")
-                st.stop()
-
-            df_weather["time"] = pd.to_datetime(df_weather["time"])
-            df_weather = df_weather.set_index("time").sort_index()
-
-            # Check if the selected meteorological column exists
-            if met_col not in df_weather.columns:
+            # Weather variable averaged per freq bin (from cached hourly prefix sums)
+            try:
+                series_met = get_weather_series(lat, lon, f"{MIN_YEAR}-01-01", f"{MAX_YEAR}-12-31", met_col, freq)
+            except KeyError:
                 st.error(f"Meteorological variable '{met_col}' not found in weather data.")
                 st.stop()
-
-            # Resample weather data
-            series_met = df_weather[met_col].resample(freq).mean()
+            except Exception as e:
+                st.error(f"Error loading weather data: {e}")
+                st.stop()
 
             # Ensure both series are timezone-naive
             series_met = series_met.tz_localize(None) if hasattr(series_met.index, 'tz') and series_met.index.tz is not None else series_met
             series_energy = series_energy.tz_localize(None) if hasattr(series_energy.index, 'tz') and series_energy.index.tz is not None else series_energy
 
+            # Align once: weather on the energy time grid, reused by the correlation and the lag scan
+            x = series_met.reindex(series_energy.index).to_numpy(dtype=np.float64)
+            y = series_energy.to_numpy(dtype=np.float64)
+
             # Compute correlation
-            corr_series = compute_rolled_corr(series_met, series_energy, window_len, lag)
+            valid, corr = compute_rolled_corr(x, y, window_len, lag)
+            corr_series = pd.Series(corr, index=series_energy.index[valid])
 
             series_energy_plot = series_energy
             series_met_plot = series_met
             if normalize_plot:
                 # Align both series
-                df_align = pd.concat([series_energy, series_met], axis=1).dropna()
-                series_energy_plot = pd.Series(zscore(df_align["quantity_kwh"]), index=df_align.index, name="quantity_kwh")
-                series_met_plot = pd.Series(zscore(df_align[met_col]), index=df_align.index, name=met_col)
+                e, m, index = fast_align(series_energy, series_met, pd.Timedelta(to_offset(freq).nanos))
+                # z-score in place: the aligned arrays are fresh copies
+                for arr in (e, m):
+                    arr -= arr.mean()
+                    arr /= arr.std()
+                series_energy_plot = pd.Series(e, index=index, name="quantity_kwh")
+                series_met_plot = pd.Series(m, index=index, name=met_col)
+
+            # Extreme-event mask on the correlation index
+            mask = None
+            if event_mode != "None" and not corr_series.empty:
+                if event_mode == "By threshold":
+                    # A period is extreme when any hour in it crosses the threshold
+                    hourly = get_weather_series(lat, lon, f"{MIN_YEAR}-01-01", f"{MAX_YEAR}-12-31", met_col, "H")
+                    v = hourly.to_numpy()
+                    hit = (v > thr_val) if thr_dir=="Above" else (v < thr_val)
+                    step = to_offset(freq).nanos // pd.Timedelta(hours=1).value
+                    first = (hourly.index[0].tz_localize(None) - series_met.index[0]) // pd.Timedelta(hours=1)
+                    bucket_ids = (first + np.arange(v.size, dtype=np.int64)) // step
+                    flags = bucket_or(hit, bucket_ids, len(series_met))
+                    mask = pd.Series(flags, index=series_met.index).reindex(corr_series.index, fill_value=False).to_numpy()
+                else:
+                    mask = np.zeros(len(corr_series), dtype=bool)
+                    if len(date_range)==2:
+                        t = corr_series.index.to_numpy()
+                        mask = (t >= np.datetime64(date_range[0])) & (t <= np.datetime64(date_range[1]))
 
             # ===================== PLOTS =========================
             st.subheader("📌 Aligned time-series (normalized)" if normalize_plot else "📌 Aligned time-series")
-            fig = px.line(pd.concat([series_met_plot, series_energy_plot], axis=1))
+            # WebGL traces from plain arrays
+            fig = go.Figure()
+            fig.add_trace(go.Scattergl(x=series_met_plot.index.to_numpy(), y=series_met_plot.to_numpy(), mode="lines", name=met_col))
+            fig.add_trace(go.Scattergl(x=series_energy_plot.index.to_numpy(), y=series_energy_plot.to_numpy(), mode="lines", name="quantity_kwh"))
             st.plotly_chart(fig, use_container_width=True)
 
             st.subheader("🔄 Sliding-window correlation")
@@ -183,31 +210,33 @@ def app():
             - **Near zero (~0)**: Little to no linear relationship in that period.
             Use this to detect periods when the weather has the most impact on energy production or consumption.
             """)
-            fig_corr = px.line(x=corr_series.index, y=corr_series.values,
-                            labels={"x":"Time", "y":"Correlation"},
-                            title="Correlation over time")
-            fig_corr.update_layout(yaxis=dict(range=[-1,1]))
+            fig_corr = go.Figure(go.Scattergl(x=corr_series.index.to_numpy(), y=corr_series.to_numpy(), mode="lines"))
+            fig_corr.update_layout(title="Correlation over time", xaxis_title="Time", yaxis=dict(title="Correlation", range=[-1,1]))
+            if mask is not None:
+                # Start/end of each run of extreme periods, found from the mask edges;
+                # a run ends where the period after its last flagged one starts
+                edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+                starts = corr_series.index[np.flatnonzero(edges == 1)]
+                ends = corr_series.index[np.flatnonzero(edges == -1) - 1] + to_offset(freq)
+                fig_corr.update_layout(shapes=[
+                    dict(type="rect", xref="x", yref="paper", x0=x0, x1=x1, y0=0, y1=1,
+                         fillcolor="red", opacity=0.15, line_width=0, layer="below")
+                    for x0, x1 in zip(starts, ends)
+                ])
             st.plotly_chart(fig_corr, use_container_width=True)
 
             # 3) Extreme event comparison
-            if event_mode != "None" and not corr_series.empty:
+            if mask is not None:
                 st.subheader("🌪 Effect of extreme weather on correlation")
-                if event_mode == "By threshold":
-                    mask = (df_weather[met_col] > thr_val) if thr_dir=="Above" else (df_weather[met_col] < thr_val)
-                    mask = mask.resample(freq).max().reindex(corr_series.index).fillna(False)
-                else:
-                    mask = pd.Series(False, index=corr_series.index)
-                    if len(date_range)==2:
-                        mask[(corr_series.index >= pd.to_datetime(date_range[0])) &
-                            (corr_series.index <= pd.to_datetime(date_range[1]))] = True
-                r_event = corr_series[mask].dropna()
-                r_normal = corr_series[~mask].dropna()
+                corr_values = corr_series.to_numpy()
+                r_event = corr_values[mask & ~np.isnan(corr_values)]
+                r_normal = corr_values[~mask & ~np.isnan(corr_values)]
                 if len(r_event)>2 and len(r_normal)>2:
                     stat, p = ttest_ind(r_event, r_normal, equal_var=False)
                     st.write(f"**Mean correlation (extreme): {r_event.mean():.3f}**")
                     st.write(f"**Mean correlation (normal): {r_normal.mean():.3f}**")
                     st.write(f"**p-value = {p:.4f}** *(p<0.05 → significantly different)*")
-                    fig_compare = px.box(pd.DataFrame({"Extreme":r_event, "Normal":r_normal}), title="Correlation distribution")
+                    fig_compare = px.box(pd.DataFrame({"Extreme":pd.Series(r_event), "Normal":pd.Series(r_normal)}), title="Correlation distribution")
                     st.plotly_chart(fig_compare, use_container_width=True)
                 else:
                     st.info("Not enough event data to compare statistically.")
@@ -221,10 +250,26 @@ def app():
             - Peaks indicate the lag at which the weather most strongly affects energy.
             For example, if the highest correlation occurs at lag = 3 hours, it means changes in the weather influence energy about 3 hours later.
             """)
-            lags = range(-72, 73)
-            mean_corrs = [compute_rolled_corr(series_met, series_energy, window_len, L).mean() for L in lags]
-            fig_lag = px.line(x=list(lags), y=mean_corrs,
-                            labels={"x":"Lag (periods)", "y":"Mean correlation"})
+            if full_lag_scan:
+                lags = np.arange(-72, 73)
+                mean_corrs = mean_corr_vs_lag(x, y, window_len, lags)
+            else:
+                # Coarse pass, then every lag around the strongest coarse point
+                coarse = np.arange(-72, 73, 8)
+                coarse_corrs = mean_corr_vs_lag(x, y, window_len, coarse)
+                if np.isnan(coarse_corrs).all():
+                    lags, mean_corrs = coarse, coarse_corrs
+                else:
+                    peak = coarse[np.nanargmax(np.abs(coarse_corrs))]
+                    fine = np.setdiff1d(np.arange(max(peak - 7, -72), min(peak + 8, 73)), coarse)
+                    fine_corrs = mean_corr_vs_lag(x, y, window_len, fine)
+                    lags = np.concatenate([coarse, fine])
+                    order = np.argsort(lags)
+                    lags, mean_corrs = lags[order], np.concatenate([coarse_corrs, fine_corrs])[order]
+            fig_lag = go.Figure(go.Scattergl(x=lags, y=mean_corrs, mode="lines" if full_lag_scan else "lines+markers"))
+            fig_lag.update_layout(xaxis_title="Lag (periods)", yaxis_title="Mean correlation")
+            if not np.isnan(mean_corrs).all():
+                st.write(f"**Strongest mean correlation at lag {lags[np.nanargmax(np.abs(mean_corrs))]}**")
             st.plotly_chart(fig_lag, use_container_width=True)
             st.success("🎉 Analysis completed!")
     else:
@@ -5,9 +5,8 @@ import numpy as np
 import plotly.express as px
 import statsmodels.api as sm
 from datetime import datetime, timedelta
-from scipy.stats import zscore
 import time
-from utils.data_loader import load_mongo_data, download_weather_data_chunked
+from utils.data_loader import get_energy_series, download_weather_data_chunked
 from utils.config import PRICE_AREAS, DEFAULT_HOURLY_VARIABLES
 
 def app():
@@ -31,38 +30,13 @@ def app():
     st.subheader("🔧 Dataset selection")
     mode = st.radio("Energy dataset", ["Production", "Consumption"])
     collection_name = "production_data" if mode == "Production" else "consumption_data"
-    if f"df_{collection_name}" not in st.session_state:
-        st.session_state[f"df_{collection_name}"] = load_mongo_data(collection_name)
-    df_energy = st.session_state[f"df_{collection_name}"]
-    if df_energy.empty:
-        st.error("No data loaded. Please check your MongoDB connection and data.")
-        st.stop()
-
     price_area = st.selectbox(
         "Price area",
         options=list(PRICE_AREAS.keys()),
         format_func=lambda x: f"{x} — {PRICE_AREAS[x]['city']}"
     )
-
-    # -------------------------------------------------------
-    # Energy series preparation
-    # -------------------------------------------------------
-    @st.cache_data
-    def prepare_energy_series(df, price_area, freq="H"):
-        if "price_area" not in df.columns or "start_time" not in df.columns or "quantity_kwh" not in df.columns:
-            st.error("Required columns not found in the dataset.")
-            return pd.Series(dtype=float)
-        df_area = df[df["price_area"] == price_area].copy()
-        if df_area.empty:
-            st.error(f"No data available for price area: {price_area}")
-            return pd.Series(dtype=float)
-        df_area = df_area.set_index("start_time").sort_index()
-        s = df_area["quantity_kwh"].resample(freq).sum()
-        s.name = "quantity_kwh"
-        return s
-
     freq = st.selectbox("Resample frequency", ["H", "3H", "6H", "12H", "D"])
-    series_energy = prepare_energy_series(df_energy, price_area, freq)
+    series_energy = get_energy_series(collection_name, price_area, freq)
     if series_energy.empty:
         st.error("No energy data available for the selected price area and frequency.")
         st.stop()
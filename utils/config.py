@@ -11,6 +11,7 @@ PRICE_AREAS = {
 
 # --- Open-Meteo API Configuration ---
 OPENMETEO_ERA5 = "https://archive-api.open-meteo.com/v1/era5"
+OPENMETEO_ARCHIVE = "https://archive-api.open-meteo.com/v1/archive"
 
 DEFAULT_HOURLY_VARIABLES = (
     "temperature_2m",
@@ -20,8 +21,19 @@ DEFAULT_HOURLY_VARIABLES = (
     "wind_direction_10m"
 )
 
+# Parquet files written by download_weather_data (survives app restarts)
+WEATHER_CACHE_DIR = "data/cache"
+
 # --- MongoDB Configuration ---
+MONGO_DATABASE = "elhub_data"
 MONGO_COLLECTIONS = ["production_data", "consumption_data"]
+# Fields the pages use, per collection (the group field differs between the two)
+MONGO_FIELDS = {
+    "production_data": ("price_area", "production_group", "start_time", "quantity_kwh"),
+    "consumption_data": ("price_area", "consumption_group", "start_time", "quantity_kwh"),
+}
+# Parquet snapshots written by load_mongo_data
+MONGO_CACHE_DIR = "data/cache"
 
 # --- Default Settings ---
 DEFAULT_YEAR = 2021
@@ -1,52 +1,308 @@
 # utils/data_loader.py
+import os
+import hashlib
+import tempfile
+import contextlib
 import streamlit as st
 import pandas as pd
+import numpy as np
 from pymongo import MongoClient
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from .config import PRICE_AREAS, OPENMETEO_ERA5, DEFAULT_HOURLY_VARIABLES
+from .config import (
+    PRICE_AREAS, OPENMETEO_ERA5, OPENMETEO_ARCHIVE, DEFAULT_HOURLY_VARIABLES, WEATHER_CACHE_DIR,
+    MONGO_DATABASE, MONGO_FIELDS, MONGO_CACHE_DIR
+)
 
 
-# --- MongoDB Data Loader (Cached + Session State) ---
+# --- HTTP session (keep-alive connections reused across Open-Meteo requests) ---
+# Rate-limited (429) and transient server errors are retried with exponential backoff;
+# requests' default Accept-Encoding asks for gzip/deflate, plus br only when brotli is importable
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+))
+
+# --- MongoDB Client (one connection pool per process) ---
+@st.cache_resource
+def get_mongo_client() -> MongoClient:
+    """Shared MongoClient, reused across pages and reruns."""
+    return MongoClient(st.secrets["MONGO_URI"])
+
+def latest_start_time(collection):
+    """Most recent start_time in a collection (None if empty)."""
+    latest = collection.find_one({}, {"_id": 0, "start_time": 1}, sort=[("start_time", -1)])
+    return None if latest is None else latest["start_time"]
+
+def read_cursor(cursor, n: int, dtypes: dict) -> pd.DataFrame:
+    """
+    Stream a cursor into preallocated typed columns.
+
+    n is only the initial capacity (e.g. a count taken before reading): columns grow if more
+    documents arrive and are trimmed to the rows actually read. Missing fields become
+    None / NaT / NaN. String fields (dtype object) come back as categoricals and datetime
+    fields as UTC.
+    """
+    capacity = max(n, 1)
+    columns = {field: np.empty(capacity, dtype=dtype) for field, dtype in dtypes.items()}
+    fills = {}
+    for field, column in columns.items():
+        kind = column.dtype.kind
+        fills[field] = None if kind == "O" else np.datetime64("NaT") if kind == "M" else np.nan
+    count = 0
+    for doc in cursor:
+        if count == capacity:
+            capacity *= 2
+            columns = {field: np.resize(column, capacity) for field, column in columns.items()}
+        for field, column in columns.items():
+            value = doc.get(field)
+            column[count] = fills[field] if value is None else value
+        count += 1
+    data = {}
+    for field, column in columns.items():
+        column = column[:count]
+        if column.dtype == object:
+            data[field] = pd.Categorical(column)
+        elif column.dtype.kind == "M":
+            data[field] = pd.to_datetime(column, utc=True)
+        else:
+            data[field] = column
+    return pd.DataFrame(data)
+
+def fetch_mongo_data(collection) -> pd.DataFrame:
+    """Fetch the fields the pages use from a collection into a typed DataFrame."""
+    fields = MONGO_FIELDS[collection.name]
+    # Only ship the fields the pages use (drops _id, eic, end_time, ...)
+    projection = {"_id": 0, **{field: 1 for field in fields}}
+    cursor = collection.aggregate([{"$project": projection}], allowDiskUse=True, batchSize=10000)
+    # Fill typed columns straight from the cursor (no per-row dicts kept, no dtype inference);
+    # the group field (production_group / consumption_group) and price_area are strings
+    numeric = {"start_time": "datetime64[s]", "quantity_kwh": np.float32}
+    return read_cursor(cursor, collection.count_documents({}), {
+        field: numeric.get(field, object) for field in fields
+    })
+
+# --- MongoDB Data Loader (Cached + Session State + Disk) ---
 @st.cache_data
 def load_mongo_data(collection_name: str) -> pd.DataFrame:
-    """Load data from MongoDB and store in session_state."""
+    """
+    Load data from MongoDB and store in session_state.
+
+    A parquet copy is kept in MONGO_CACHE_DIR, named after the collection and its
+    latest start_time, so a cold start only re-reads MongoDB when new data has arrived.
+    """
     if f"df_{collection_name}" not in st.session_state:
         with st.spinner(f"Loading {collection_name} from MongoDB..."):
-            MONGO_URI = st.secrets["MONGO_URI"]
-            client = MongoClient(MONGO_URI)
-            db = client["elhub_data"]
-            collection = db[collection_name]
-            st.session_state[f"df_{collection_name}"] = pd.DataFrame(list(collection.find({})))
+            collection = get_mongo_client()[MONGO_DATABASE][collection_name]
+            latest = latest_start_time(collection)
+            stamp = "empty" if latest is None else pd.Timestamp(latest).strftime("%Y%m%dT%H%M")
+            path = os.path.join(MONGO_CACHE_DIR, f"{collection_name}_{stamp}.parquet")
+            if os.path.exists(path):
+                df = pd.read_parquet(path)
+            else:
+                df = fetch_mongo_data(collection)
+                os.makedirs(MONGO_CACHE_DIR, exist_ok=True)
+                # Drop snapshots of older data for this collection; another worker may be
+                # cleaning up (or have just written the current snapshot) at the same time
+                for name in os.listdir(MONGO_CACHE_DIR):
+                    old_path = os.path.join(MONGO_CACHE_DIR, name)
+                    if name.startswith(f"{collection_name}_") and name.endswith(".parquet") and old_path != path:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(old_path)
+                # Write to a temp file and move it into place, so readers never see a partial parquet
+                fd, tmp_path = tempfile.mkstemp(dir=MONGO_CACHE_DIR, suffix=".tmp")
+                os.close(fd)
+                try:
+                    df.to_parquet(tmp_path, compression="zstd")
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(tmp_path)
+                    raise
+            st.session_state[f"df_{collection_name}"] = df
     return st.session_state[f"df_{collection_name}"]
 
-# --- Weather Data Loader (Cached + Session State) ---
+# --- Energy of One Price Area (filtered in MongoDB) ---
+@st.cache_data
+def load_area_energy(collection_name: str, price_area: str, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+    """
+    Hourly start_time / quantity_kwh of one price area, filtered and projected server-side.
+
+    The $match on price_area (and start_time when start/end are given) is served by a
+    compound index on the collection: create_index([("price_area", 1), ("start_time", 1)]).
+
+    Args:
+        collection_name (str): MongoDB collection ("production_data" or "consumption_data").
+        price_area (str): Price area code, e.g. "NO1".
+        start (datetime, optional): First start_time to include.
+        end (datetime, optional): Last start_time to include.
+
+    Returns:
+        pd.DataFrame: start_time (UTC) and quantity_kwh (float32) columns.
+    """
+    collection = get_mongo_client()[MONGO_DATABASE][collection_name]
+    match = {"price_area": price_area}
+    if start is not None or end is not None:
+        match["start_time"] = {}
+        if start is not None:
+            match["start_time"]["$gte"] = start
+        if end is not None:
+            match["start_time"]["$lte"] = end
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "start_time": 1, "quantity_kwh": 1}},
+    ]
+    cursor = collection.aggregate(pipeline, allowDiskUse=True, batchSize=10000)
+    return read_cursor(cursor, collection.count_documents(match), {
+        "start_time": "datetime64[s]",
+        "quantity_kwh": np.float32,
+    })
+
+# --- Hourly Prefix Sums (any coarser freq is read off them) ---
+def hourly_prefix_sums(s: pd.Series):
+    """Prefix sums and prefix non-NaN counts (length n + 1) of an hourly series on a regular grid."""
+    values = s.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values)
+    cs = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    cn = np.concatenate([[0], np.cumsum(valid)])
+    return s.index[0], cs, cn
+
+def bin_prefix_sums(t0, cs, cn, freq: str, how: str = "sum") -> pd.Series:
+    """Per-`freq` sums (empty bins 0) or means (empty bins NaN) of the hourly series starting at t0."""
+    n = cs.size - 1
+    labels = pd.date_range(t0.floor(freq), t0 + pd.Timedelta(hours=n - 1), freq=freq)
+    lo = np.clip(((labels - t0) // pd.Timedelta(hours=1)).to_numpy(), 0, n)
+    hi = np.r_[lo[1:], n]
+    values = cs[hi] - cs[lo]
+    if how == "mean":
+        counts = cn[hi] - cn[lo]
+        values = np.divide(values, counts, out=np.full(values.size, np.nan), where=counts > 0)
+    return pd.Series(values, index=labels)
+
+@st.cache_data
+def energy_prefix_sums(collection_name: str, price_area: str, start: datetime = None, end: datetime = None):
+    """Hourly prefix sums of one price area's quantity_kwh (None if there is no data)."""
+    df_area = load_area_energy(collection_name, price_area, start, end)
+    if df_area.empty:
+        return None
+    return hourly_prefix_sums(df_area.groupby(pd.Grouper(key="start_time", freq="h"))["quantity_kwh"].sum())
+
+@st.cache_data
+def weather_prefix_sums(latitude: float, longitude: float, start_date: str, end_date: str, variable: str):
+    """Hourly prefix sums of one weather variable (None if there is no data)."""
+    df = download_weather_data(latitude, longitude, start_date, end_date)
+    if df.empty:
+        return None
+    return hourly_prefix_sums(df.set_index("time")[variable].resample("h").mean())
+
+# --- Resampled Energy / Weather Series ---
+@st.cache_data
+def get_energy_series(collection_name: str, price_area: str, freq: str = "H", start: datetime = None, end: datetime = None) -> pd.Series:
+    """
+    quantity_kwh of one price area summed per `freq` bin.
+
+    Bins are differences of hourly prefix sums computed once per area, so changing `freq`
+    costs O(bins); the cache key is the small argument tuple, never a hashed frame.
+    """
+    sums = energy_prefix_sums(collection_name, price_area, start, end)
+    if sums is None:
+        return pd.Series(dtype=float, name="quantity_kwh")
+    return bin_prefix_sums(*sums, freq, how="sum").rename("quantity_kwh")
+
+@st.cache_data
+def get_weather_series(latitude: float, longitude: float, start_date: str, end_date: str, variable: str, freq: str = "H") -> pd.Series:
+    """Mean of one weather variable per `freq` bin, from hourly prefix sums."""
+    sums = weather_prefix_sums(latitude, longitude, start_date, end_date, variable)
+    if sums is None:
+        return pd.Series(dtype=float, name=variable)
+    return bin_prefix_sums(*sums, freq, how="mean").rename(variable)
+
+# --- Mean quantity per price area (aggregated in MongoDB) ---
+@st.cache_data(ttl=600)
+def load_mean_per_area(collection_name: str, days: int) -> pd.DataFrame:
+    """Mean quantity_kwh per price area over the last `days` days of data."""
+    collection = get_mongo_client()[MONGO_DATABASE][collection_name]
+
+    date_max = latest_start_time(collection)
+    if date_max is None:
+        return pd.DataFrame(columns=["price_area", "quantity_kwh"])
+    date_min = date_max - timedelta(days=days)
+
+    pipeline = [
+        {"$match": {"start_time": {"$gte": date_min, "$lte": date_max}}},
+        {"$group": {"_id": "$price_area", "quantity_kwh": {"$avg": "$quantity_kwh"}}},
+        {"$project": {"_id": 0, "price_area": "$_id", "quantity_kwh": {"$round": ["$quantity_kwh", 2]}}},
+    ]
+    df = pd.DataFrame(list(collection.aggregate(pipeline, allowDiskUse=True)))
+    if df.empty:
+        return pd.DataFrame(columns=["price_area", "quantity_kwh"])
+    return df
+
+# --- Weather Data Disk Cache ---
+def weather_cache_key(params: dict) -> str:
+    """Short stable digest of the Open-Meteo request parameters."""
+    return hashlib.blake2b(orjson.dumps(params, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
+
+def weather_cache_path(params: dict) -> str:
+    """Parquet path holding the response to one Open-Meteo request."""
+    return os.path.join(WEATHER_CACHE_DIR, f"weather_{weather_cache_key(params)}.parquet")
+
+# --- Weather Data Loader (Cached + Session State + Disk) ---
 @st.cache_data
 def download_weather_data(
     latitude: float,
     longitude: float,
-    year: int,
+    start_date: str,
+    end_date: str,
     hourly=DEFAULT_HOURLY_VARIABLES
 ) -> pd.DataFrame:
-    """Download weather data from Open-Meteo API."""
-    cache_key = f"weather_{latitude}_{longitude}_{year}"
+    """
+    Download weather data from Open-Meteo API in a single request.
+
+    Args:
+        latitude (float): Latitude.
+        longitude (float): Longitude.
+        start_date (str): Start date in YYYY-MM-DD format.
+        end_date (str): End date in YYYY-MM-DD format (inclusive).
+        hourly (tuple): Hourly variables to download.
+
+    Returns:
+        pd.DataFrame: A 'time' column (UTC) plus one float32 column per hourly variable.
+    """
+    # Coordinates rounded to ~100 m, so nearby map clicks share one request and cache file
+    params = {
+        "latitude": round(float(latitude), 3),
+        "longitude": round(float(longitude), 3),
+        "start_date": start_date,
+        "end_date": end_date,
+        "hourly": ",".join(hourly),
+        "timezone": "UTC"
+    }
+    cache_key = f"weather_{weather_cache_key(params)}"
     if cache_key not in st.session_state:
-        with st.spinner(f"Downloading weather data for {year}..."):
-            params = {
-                "latitude": latitude,
-                "longitude": longitude,
-                "start_date": f"{year}-01-01",
-                "end_date": f"{year}-12-31",
-                "hourly": ",".join(hourly),
-                "timezone": "UTC"
-            }
-            response = requests.get(OPENMETEO_ERA5, params=params, timeout=30)
-            response.raise_for_status()
-            hourly_data = response.json().get("hourly", {})
-            df = pd.DataFrame({"time": pd.to_datetime(hourly_data.get("time", []), utc=True)})
-            for v in hourly:
-                df[v] = pd.to_numeric(hourly_data.get(v, []), errors="coerce")
-            st.session_state[cache_key] = df
+        path = weather_cache_path(params)
+        if os.path.exists(path):
+            st.session_state[cache_key] = pd.read_parquet(path)
+        else:
+            with st.spinner(f"Downloading weather data from {start_date} to {end_date}..."):
+                response = SESSION.get(OPENMETEO_ERA5, params=params, timeout=60)
+                response.raise_for_status()
+                hourly_data = orjson.loads(response.content).get("hourly", {})
+                # Build all columns first, then the frame in one go (no per-column inserts);
+                # float32 is lossless for ERA5 values and halves the memory traffic downstream
+                data = {"time": pd.to_datetime(hourly_data.get("time", []), utc=True, format="%Y-%m-%dT%H:%M").as_unit("s")}
+                for v in hourly:
+                    data[v] = np.asarray(hourly_data.get(v, []), dtype=np.float32)
+                df = pd.DataFrame(data)
+                os.makedirs(WEATHER_CACHE_DIR, exist_ok=True)
+                df.to_parquet(path, compression="zstd")
+                st.session_state[cache_key] = df
     return st.session_state[cache_key]
 
 # --- Load Weather Data by Price Area ---
@@ -54,11 +310,37 @@ def download_weather_data(
 def load_weather_data(price_area_code: str, year: int) -> pd.DataFrame:
     """Load weather data for a specific price area."""
     loc = PRICE_AREAS[price_area_code]
-    return download_weather_data(latitude=loc["lat"], longitude=loc["lon"], year=year)
+    return download_weather_data(
+        latitude=loc["lat"],
+        longitude=loc["lon"],
+        start_date=f"{year}-01-01",
+        end_date=f"{year}-12-31"
+    )
+
+def fetch_weather_chunk(lat, lon, start, end, hourly) -> pd.DataFrame:
+    """Fetch one date window of hourly weather data, indexed by time."""
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "start_date": start.strftime("%Y-%m-%d"),
+        "end_date": end.strftime("%Y-%m-%d"),
+        "hourly": hourly,
+        "timezone": "UTC"
+    }
+    response = SESSION.get(OPENMETEO_ARCHIVE, params=params, timeout=60)
+    if response.status_code != 200:
+        raise ValueError(f"Failed to fetch weather data: {response.text}")
 
-def download_weather_data_chunked(lat, lon, start_date, end_date, hourly):
+    hourly_data = orjson.loads(response.content)["hourly"]
+
+    # Convert to DataFrame in one construction; None (missing) values become NaN
+    data = {v: np.asarray(hourly_data.get(v) or [], dtype=np.float32) for v in hourly}
+    index = pd.DatetimeIndex(pd.to_datetime(hourly_data["time"], utc=True, format="%Y-%m-%dT%H:%M").as_unit("s"), name="time")
+    return pd.DataFrame(data, index=index)
+
+def download_weather_data_chunked(lat, lon, start_date, end_date, hourly, max_workers=8):
     """
-    Download weather data from Open-Meteo API in chunks.
+    Download weather data from Open-Meteo API in chunks, fetched in parallel.
 
     Args:
         lat (float): Latitude.
@@ -66,51 +348,31 @@ def download_weather_data_chunked(lat, lon, start_date, end_date, hourly):
         start_date (str): Start date in YYYY-MM-DD format.
         end_date (str): End date in YYYY-MM-DD format.
         hourly (list): List of hourly variables to download.
+        max_workers (int): Maximum number of concurrent requests.
 
     Returns:
         pd.DataFrame: Weather data.
     """
-    base_url = "https://archive-api.open-meteo.com/v1/archive"
-    df_list = []
-
     # Convert dates to datetime objects
     start = datetime.fromisoformat(start_date)
     end = datetime.fromisoformat(end_date)
 
-    # Loop through date ranges in chunks (e.g., 30 days at a time)
+    # Split the range into chunks (e.g., 30 days at a time)
     chunk_size = timedelta(days=30)
+    chunks = []
     current_start = start
-
     while current_start <= end:
         current_end = min(current_start + chunk_size, end)
-
-        # Request data for the current chunk
-        params = {
-            "latitude": lat,
-            "longitude": lon,
-            "start_date": current_start.strftime("%Y-%m-%d"),
-            "end_date": current_end.strftime("%Y-%m-%d"),
-            "hourly": hourly,
-            "timezone": "UTC"
-        }
-
-        response = requests.get(base_url, params=params)
-        if response.status_code != 200:
-            raise ValueError(f"Failed to fetch weather data: {response.text}")
-
-        data = response.json()
-
-        # Convert to DataFrame
-        df = pd.DataFrame(data["hourly"])
-        df["time"] = pd.to_datetime(df["time"])
-        df.set_index("time", inplace=True)
-        df_list.append(df)
-
+        chunks.append((current_start, current_end))
         current_start = current_end + timedelta(days=1)
 
-    # Concatenate all chunks
-    if not df_list:
+    if not chunks:
         return pd.DataFrame()
 
+    # The requests are network-bound, so fetch the chunks concurrently over the shared session
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+        df_list = list(executor.map(lambda c: fetch_weather_chunk(lat, lon, c[0], c[1], hourly), chunks))
+
+    # Concatenate all chunks (map keeps them in date order)
     df_weather = pd.concat(df_list)
-    return df_weather
\ No newline at end of file
+    return df_weather
@@ -0,0 +1,261 @@
+# utils/kernels.py
+import numpy as np
+import numba
+from numba import njit, prange
+
+# The parallel kernels are called from Streamlit's per-session script threads; the default
+# "workqueue" fallback aborts the process on concurrent use, so require tbb (or omp)
+numba.config.THREADING_LAYER = "threadsafe"
+
+# fastmath without the "no NaNs / no infs" flags, so the NaN checks below are kept
+FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+# --- Snow drift (Tabler) ---
+# Open-Meteo returns wind_speed_10m in km/h (no wind_speed_unit is requested) at 0.1 km/h
+# resolution, so u ** 3.8 is looked up rather than computed; 2048 steps cover 0-204.7 km/h
+U38_STEPS = 2048
+U38 = (np.arange(U38_STEPS) / 10.0) ** 3.8
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def u38(u):
+    """u ** 3.8 from the lookup table, falling back to pow beyond 204.7 km/h."""
+    k = int(u * 10.0 + 0.5)
+    if k < U38_STEPS:
+        return U38[k]
+    return u ** 3.8
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def qupot_kernel(wind_speeds, dt):
+    """Potential wind-driven transport Qupot (kg/m), skipping NaN samples."""
+    total = 0.0
+    for i in range(wind_speeds.size):
+        u = wind_speeds[i]
+        if np.isnan(u):
+            continue
+        total += u38(u)
+    return total * dt / 233847.0
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def sector_transport_kernel(wind_speeds, wind_dirs, season_codes, n_seasons, dt):
+    """Snow transport per 16 wind sectors, one row per season."""
+    sectors = np.zeros((n_seasons, 16))
+    for i in range(wind_speeds.size):
+        u = wind_speeds[i]
+        d = wind_dirs[i]
+        if np.isnan(u) or np.isnan(d):
+            continue
+        k = int(((d + 11.25) % 360.0) // 22.5)
+        sectors[season_codes[i], k] += u38(u) * dt / 233847.0
+    return sectors
+
+
+# --- Rolling correlation ---
+@njit(cache=True, fastmath=FASTMATH)
+def window_moments(x, y, lo, hi):
+    """Two-pass count, means and co-moments of the valid pairs in x[lo:hi], y[lo:hi]."""
+    nobs = 0
+    mx = my = 0.0
+    for i in range(lo, hi):
+        if not (np.isnan(x[i]) or np.isnan(y[i])):
+            nobs += 1
+            mx += x[i]
+            my += y[i]
+    if nobs == 0:
+        return 0, 0.0, 0.0, 0.0, 0.0, 0.0
+    mx /= nobs
+    my /= nobs
+    ssx = ssy = cxy = 0.0
+    for i in range(lo, hi):
+        if not (np.isnan(x[i]) or np.isnan(y[i])):
+            dx = x[i] - mx
+            dy = y[i] - my
+            ssx += dx * dx
+            ssy += dy * dy
+            cxy += dx * dy
+    return nobs, mx, my, ssx, ssy, cxy
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def rolling_corr(x, y, w):
+    """Pearson correlation over a trailing window of w samples (NaN until the window holds w valid pairs).
+
+    Means and co-moments are updated Welford-style as pairs enter and leave the window, and
+    recomputed exactly every w steps so rounding drift cannot build up on series with large
+    offsets (e.g. kWh totals around 1e9). Pairs with a NaN on either side are left out.
+    """
+    n = x.size
+    out = np.full(n, np.nan)
+    nobs = 0
+    mx = my = ssx = ssy = cxy = 0.0
+    for i in range(n):
+        if i >= w and i % w == 0:
+            nobs, mx, my, ssx, ssy, cxy = window_moments(x, y, i - w + 1, i + 1)
+        else:
+            xi = x[i]
+            yi = y[i]
+            if not (np.isnan(xi) or np.isnan(yi)):
+                nobs += 1
+                dx = xi - mx
+                mx += dx / nobs
+                my_old = my
+                my += (yi - my) / nobs
+                ssx += dx * (xi - mx)
+                ssy += (yi - my_old) * (yi - my)
+                cxy += dx * (yi - my)
+            if i >= w:
+                xj = x[i - w]
+                yj = y[i - w]
+                if not (np.isnan(xj) or np.isnan(yj)):
+                    nobs -= 1
+                    if nobs == 0:
+                        mx = my = ssx = ssy = cxy = 0.0
+                    else:
+                        mx_old = mx
+                        my_old = my
+                        mx -= (xj - mx) / nobs
+                        my -= (yj - my) / nobs
+                        ssx -= (xj - mx_old) * (xj - mx)
+                        ssy -= (yj - my_old) * (yj - my)
+                        cxy -= (xj - mx) * (yj - my_old)
+        if nobs >= w and ssx > 0.0 and ssy > 0.0:
+            out[i] = cxy / np.sqrt(ssx * ssy)
+    return out
+
+
+@njit(cache=True)
+def prefix_sums(v):
+    """Prefix sums of v and v**2 (length n + 1), after removing the mean of v."""
+    n = v.size
+    mu = v.mean() if n > 0 else 0.0
+    s = np.zeros(n + 1)
+    ss = np.zeros(n + 1)
+    for i in range(n):
+        d = v[i] - mu
+        s[i + 1] = s[i] + d
+        ss[i + 1] = ss[i] + d * d
+    return s, ss, mu
+
+
+@njit(parallel=True, cache=True)
+def mean_corr_vs_lag_dense(x, y, w, lags):
+    """mean_corr_vs_lag for NaN-free inputs: the x and y window sums come from prefix sums
+    shared by every lag, so each lag only runs the x*y product over the overlap."""
+    n = x.size
+    sx_, sxx_, mx = prefix_sums(x)
+    sy_, syy_, my = prefix_sums(y)
+    out = np.empty(lags.size)
+    for k in prange(lags.size):
+        lag = lags[k]
+        lo = max(0, -lag)
+        m = min(n, n - lag) - lo
+        sxy = 0.0
+        total = 0.0
+        count = 0
+        for p in range(m):
+            i = lo + p
+            sxy += (x[i] - mx) * (y[i + lag] - my)
+            if p >= w:
+                j = i - w
+                sxy -= (x[j] - mx) * (y[j + lag] - my)
+            if p >= w - 1:
+                a = i + 1 - w
+                sx = sx_[i + 1] - sx_[a]
+                sy = sy_[i + lag + 1] - sy_[a + lag]
+                vx = sxx_[i + 1] - sxx_[a] - sx * sx / w
+                vy = syy_[i + lag + 1] - syy_[a + lag] - sy * sy / w
+                if vx > 0.0 and vy > 0.0:
+                    total += (sxy - sx * sy / w) / np.sqrt(vx * vy)
+                    count += 1
+        out[k] = total / count if count > 0 else np.nan
+    return out
+
+
+@njit(cache=True, fastmath=FASTMATH)
+def rolling_corr_mean(x, y, w, lag, mx, my):
+    """Mean of rolling_corr over the valid pairs (x[i], y[i + lag]), without materialising them.
+
+    A trailing pointer walks the same valid pairs to drop the one leaving the window, so the
+    extra memory is O(1). Values are centred on mx / my to keep the running sums small.
+    """
+    n = x.size
+    lo = max(0, -lag)
+    hi = min(n, n - lag)
+    sx = sy = sxx = syy = sxy = 0.0
+    nobs = 0
+    j = lo
+    total = 0.0
+    count = 0
+    for i in range(lo, hi):
+        a = x[i]
+        b = y[i + lag]
+        if np.isnan(a) or np.isnan(b):
+            continue
+        a -= mx
+        b -= my
+        sx += a
+        sy += b
+        sxx += a * a
+        syy += b * b
+        sxy += a * b
+        nobs += 1
+        if nobs > w:
+            while np.isnan(x[j]) or np.isnan(y[j + lag]):
+                j += 1
+            a = x[j] - mx
+            b = y[j + lag] - my
+            sx -= a
+            sy -= b
+            sxx -= a * a
+            syy -= b * b
+            sxy -= a * b
+            nobs -= 1
+            j += 1
+        if nobs == w:
+            vx = sxx - sx * sx / w
+            vy = syy - sy * sy / w
+            if vx > 0.0 and vy > 0.0:
+                total += (sxy - sx * sy / w) / np.sqrt(vx * vy)
+                count += 1
+    return total / count if count > 0 else np.nan
+
+
+@njit(parallel=True, cache=True)
+def mean_corr_vs_lag(x, y, w, lags):
+    """Mean rolling correlation of x against y shifted by each lag (y leads for lag > 0)."""
+    if not (np.isnan(x).any() or np.isnan(y).any()):
+        return mean_corr_vs_lag_dense(x, y, w, lags)
+    mx = np.nanmean(x)
+    my = np.nanmean(y)
+    out = np.empty(lags.size)
+    for k in prange(lags.size):
+        out[k] = rolling_corr_mean(x, y, w, lags[k], mx, my)
+    return out
+
+
+# --- Event masks ---
+@njit(cache=True)
+def bucket_or(vals, bucket_ids, n_buckets):
+    """Per-bucket logical OR of a boolean array (bucket_ids outside [0, n_buckets) are ignored)."""
+    out = np.zeros(n_buckets, np.bool_)
+    for i in range(vals.size):
+        b = bucket_ids[i]
+        if vals[i] and 0 <= b < n_buckets:
+            out[b] = True
+    return out
+
+
+# --- Warm-up ---
+# Compile (or load from the on-disk cache) once per process, with the dtypes the pages pass in,
+# so the first Streamlit run does not pay the JIT latency
+_w32 = np.zeros(4, dtype=np.float32)
+_w64 = np.zeros(4)
+qupot_kernel(_w32, 3600.0)
+sector_transport_kernel(_w32, _w32, np.zeros(4, dtype=np.int64), 1, 3600.0)
+rolling_corr(_w64, _w64, 2)
+mean_corr_vs_lag(_w64, _w64, 2, np.zeros(1, dtype=np.int64))
+bucket_or(np.zeros(4, dtype=np.bool_), np.zeros(4, dtype=np.int64), 1)
+del _w32, _w64